@@ -1,100 +1,81 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import json
+import hashlib
+import re
+import sqlite3
 import openai
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import redis
+import numpy as np
 from openai import OpenAI
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import (
+    Flask, Response, abort, render_template, request, redirect, url_for, session, flash,
+    make_response, stream_with_context,
+)
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
-from werkzeug.security import generate_password_hash, check_password_hash
-
+from flask_session import Session
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event, func, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import relationship, selectinload, raiseload, load_only
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
-from llama_cpp import Llama
-
-# Load the LLaMA model
-llm = Llama(model_path="llama-2-7b-chat.Q4_K_M.gguf", n_ctx=2048)
-
-# Function to generate quiz questions
-def generate_quiz_questions(content, num_questions=5):
-    prompt = f"""
-You are an AI tutor. Based on the following content, generate {num_questions} multiple-choice quiz questions. 
-Each should have 4 options (A, B, C, D), and indicate the correct answer at the end.
-
-Content:
-{content}
-
-Format:
-1) Question text...
-A) Option A
-B) Option B
-C) Option C
-D) Option D
-Correct answer: X
-"""
-    response = llm(prompt, max_tokens=700)
-    return response['choices'][0]['text'].strip()
-
-# Function to provide adaptive explanations
-def generate_adaptive_response(content, student_question):
-    prompt = f"""
-You are an AI tutor. Based on the following course content, explain clearly the answer to the student's question.
-
-Content:
-{content}
-
-Student's question: {student_question}
-
-Answer:
-"""
-    response = llm(prompt, max_tokens=400)
-    return response['choices'][0]['text'].strip()
-
-# Example usage
-if __name__ == "__main__":
-    # Sample course content
-    course_content = """
-Photosynthesis is the process by which green plants and some other organisms use sunlight to synthesize foods from carbon dioxide and water.
-Photosynthesis in plants generally involves the green pigment chlorophyll and generates oxygen as a by-product.
-"""
-
-    # Generate quiz questions
-    quiz = generate_quiz_questions(course_content, num_questions=3)
-    print("=== Quiz Questions ===")
-    print(quiz)
-
-    # Student question
-    question = "Why is chlorophyll important for photosynthesis?"
-    answer = generate_adaptive_response(course_content, question)
-    print("\n=== Adaptive Explanation ===")
-    print(answer)
+from batch import submit_quiz_batch, fetch_batch_results, batch_chat
 
 load_dotenv()  # take environment variables from .env.
 
-def fetch_moodle_courses():
+# Shared HTTP session for Moodle: keeps TLS connections alive across the
+# many calls of one import and retries transient gateway errors.
+MOODLE_SESSION = requests.Session()
+_moodle_adapter = HTTPAdapter(
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+)
+MOODLE_SESSION.mount("https://", _moodle_adapter)
+MOODLE_SESSION.mount("http://", _moodle_adapter)
+
+def moodle_call(function_name, **params):
     """
-    Fetch all courses from Moodle using the web service token
-    and return them as a list of dictionaries.
+    Call a Moodle web service function using the web service token
+    and return the decoded JSON response.
     """
     moodle_url = os.environ.get("MOODLE_URL", "https://your-moodle.com")
     moodle_token = os.environ.get("MOODLE_TOKEN", "your_moodle_token")
-    
+
     # Moodle endpoint
     endpoint = f"{moodle_url}/webservice/rest/server.php"
-    
-    # Example function name to get ALL courses
-    function_name = "core_course_get_courses"  
-    
-    params = {
+
+    params.update({
         "wstoken": moodle_token,
         "wsfunction": function_name,
         "moodlewsrestformat": "json",
-    }
+    })
 
-    response = requests.get(endpoint, params=params)
+    response = MOODLE_SESSION.get(endpoint, params=params, headers={"Accept-Encoding": "gzip"}, timeout=(5, 30))
     response.raise_for_status()  # Raise HTTPError if the request failed
-    courses_data = response.json()
-    
-    return courses_data
+    return response.json()
+
+def fetch_moodle_courses():
+    """
+    Fetch all courses from Moodle and return them as a list of dictionaries.
+    """
+    return moodle_call("core_course_get_courses")
+
+def fetch_course_contents(moodle_course_id):
+    """
+    Fetch the sections (with their modules) of one Moodle course.
+    """
+    return moodle_call("core_course_get_contents", courseid=moodle_course_id)
 
 ###############################################################################
 # Configuration & Initialization
@@ -105,13 +86,140 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'replace_with_secure_key')
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///lms_app.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"pool_size": 10, "pool_pre_ping": True}
+
+# Reuse compiled template bytecode across workers and restarts. Without
+# JINJA_CACHE_DIR, Jinja uses its own per-user, owner-checked 0700
+# directory; never point this at a shared, predictable path.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.environ.get('JINJA_CACHE_DIR'))
+
+# Redis: server-side sessions, cross-worker locks and the read cache
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+app.config['SESSION_TYPE'] = 'redis'
+redis_client = redis.from_url(REDIS_URL)
+app.config['SESSION_REDIS'] = redis_client
+Session(app)
+
+# Shared cache for hot, rarely changing reads (module pages); kept in
+# Redis so an invalidation reaches every worker
+cache = Cache(app, config={
+    'CACHE_TYPE': 'RedisCache',
+    'CACHE_REDIS_URL': REDIS_URL,
+    'CACHE_KEY_PREFIX': 'lms_cache:',
+    'CACHE_DEFAULT_TIMEOUT': 300,
+})
 
 # Initialize the DB and OpenAI
 db = SQLAlchemy(app)
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Use WAL so readers don't block the writer, and only fsync at
+    checkpoints (synchronous=NORMAL is safe in WAL mode).
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
 client = OpenAI(
     api_key=os.environ.get('OPENAI_API_KEY', )
 )
 
+OPENAI_MODEL = "gpt-4o-mini"
+
+# Structured output schema for generated quizzes
+QUIZ_QUESTIONS_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string"},
+            "options": {"type": "array", "items": {"type": "string"}},
+            "answer": {"type": "string", "enum": ["A", "B", "C", "D"]},
+        },
+        "required": ["question", "options", "answer"],
+        "additionalProperties": False,
+    },
+}
+
+QUIZ_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "quiz",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"questions": QUIZ_QUESTIONS_SCHEMA},
+            "required": ["questions"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Same, for one response covering several modules
+MULTI_QUIZ_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "module_quizzes",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "quizzes": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "module_id": {"type": "integer"},
+                            "questions": QUIZ_QUESTIONS_SCHEMA,
+                        },
+                        "required": ["module_id", "questions"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["quizzes"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Modules packed into one request by the parallel bulk generator
+QUIZ_MODULES_PER_REQUEST = 4
+
+# Request parameters for quiz generation, shared by the direct and batch paths
+QUIZ_REQUEST_PARAMS = {
+    "model": OPENAI_MODEL,
+    "max_tokens": 700,
+    "temperature": 0,
+    "top_p": 1,
+    "response_format": QUIZ_RESPONSE_FORMAT,
+}
+
+# Tutor answers are reused for questions at least this similar
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# Argon2id password hashing with the OWASP baseline (19 MiB, t=2, p=1);
+# older hashes are upgraded on the next successful login
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+# Upper bound on in-flight tutor calls per process, shared across requests
+tutor_semaphore = threading.BoundedSemaphore(10)
+
+# Retry policy for transient OpenAI failures on the tutor paths
+openai_retry = retry(
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)),
+    wait=wait_exponential(),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+
 
 ###############################################################################
 # Database Models
@@ -125,49 +233,307 @@ class User(db.Model):
     
     # Helper method to check password
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """
+        Verify a password against the stored hash. Legacy Werkzeug hashes
+        and Argon2 hashes with outdated parameters are upgraded in place;
+        the caller commits the session to persist the new hash.
+        """
+        if not self.password_hash.startswith('$argon2'):
+            if not check_password_hash(self.password_hash, password):
+                return False
+            self.password_hash = password_hasher.hash(password)
+            return True
+
+        try:
+            password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if password_hasher.check_needs_rehash(self.password_hash):
+            self.password_hash = password_hasher.hash(password)
+        return True
 
 class Course(db.Model):
     __tablename__ = 'courses'
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=False)
-    modules = relationship('Module', backref='course', cascade="all, delete-orphan")
+    updated_at = db.Column(db.DateTime, default=func.now(), onupdate=func.now())
+    modules = relationship('Module', back_populates='course', cascade="all, delete-orphan")
+    # Fetch the SQL-side updated_at default in the INSERT (RETURNING)
+    # rather than with a follow-up SELECT on first access
+    __mapper_args__ = {"eager_defaults": True}
 
 class Module(db.Model):
     __tablename__ = 'modules'
+    # Moodle import de-duplicates modules by (course_id, title); the
+    # course_id prefix also serves plain per-course lookups
+    __table_args__ = (db.Index('ix_module_course_title', 'course_id', 'title'),)
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text, nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('courses.id'))
+    updated_at = db.Column(db.DateTime, default=func.now(), onupdate=func.now())
+    course = relationship('Course', back_populates='modules')
+    quiz_questions = relationship('QuizQuestion', back_populates='module', order_by='QuizQuestion.id')
+    __mapper_args__ = {"eager_defaults": True}
 
 class QuizQuestion(db.Model):
     __tablename__ = 'quiz_questions'
     id = db.Column(db.Integer, primary_key=True)
     question = db.Column(db.Text, nullable=False)
-    options = db.Column(db.Text, nullable=False)      # Store multiple options as JSON or comma-separated
+    options = db.Column(db.JSON, nullable=False)      # List of options, e.g. ["A) ...", "B) ..."]
     answer = db.Column(db.String(50), nullable=False) # Correct answer
-    module_id = db.Column(db.Integer, db.ForeignKey('modules.id'))
+    module_id = db.Column(db.Integer, db.ForeignKey('modules.id'), index=True)
+    module = relationship('Module', back_populates='quiz_questions')
 
 class QuizAttempt(db.Model):
     __tablename__ = 'quiz_attempts'
+    __table_args__ = (
+        # Per-student history lookups; also serves user_id-only filters
+        db.Index('ix_attempt_user_module', 'user_id', 'module_id'),
+        # Covers the analytics GROUP BY module_id aggregate over score
+        db.Index('ix_attempt_module_score', 'module_id', 'score'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     module_id = db.Column(db.Integer, db.ForeignKey('modules.id'))
     score = db.Column(db.Float, nullable=False)
 
+class QuizCache(db.Model):
+    __tablename__ = 'quiz_cache'
+    key = db.Column(db.String(64), primary_key=True)  # sha256 of the quiz inputs, see quiz_cache_key()
+    payload = db.Column(db.Text, nullable=False)     # Generated quiz JSON
+
+class LLMCache(db.Model):
+    __tablename__ = 'llm_cache'
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), index=True, nullable=False)          # sha256 of content hash + question
+    prompt_hash = db.Column(db.String(64), index=True, nullable=False)  # sha256 of the course content
+    embedding = db.Column(db.LargeBinary, nullable=False)               # float32 question embedding
+    response = db.Column(db.Text, nullable=False)
+
+class QuizBatchJob(db.Model):
+    __tablename__ = 'quiz_batch_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.String(100), unique=True, nullable=False)  # OpenAI batch id
+    status = db.Column(db.String(20), nullable=False)
+    module_ids = db.Column(db.Text, nullable=False)  # Comma-separated module ids in the batch
+
 
 ###############################################################################
 # Database Setup Helper (Run once to create DB)
 ###############################################################################
-# @app._got_first_request
-# def create_tables():
-#     db.create_all()
+def create_app():
+    """
+    Prepare the database (tables, indexes, data migrations) and return the app.
+    Call once at boot, e.g. in the gunicorn master with --preload, so no
+    request pays for the schema checks.
+    """
+    with app.app_context():
+        db.create_all()
+        ensure_columns()
+        ensure_indexes()
+        migrate_quiz_options()
+    return app
+
+def migrate_quiz_options(batch_size=500):
+    """
+    Convert quiz options stored by older versions as "A) ..|B) .." text
+    into JSON lists. Rows that already hold JSON are left alone. Works in
+    batches so a large table is never held in memory at once.
+    """
+    while True:
+        legacy = db.session.execute(
+            text("SELECT id, options FROM quiz_questions WHERE json_valid(options) = 0 LIMIT :limit"),
+            {"limit": batch_size}
+        ).all()
+        if not legacy:
+            break
+        db.session.execute(
+            text("UPDATE quiz_questions SET options = :options WHERE id = :id"),
+            [{"id": qid, "options": json.dumps(options.split('|'))} for qid, options in legacy]
+        )
+        db.session.commit()
+
+
+def ensure_columns():
+    """
+    Add model columns missing from existing tables. Only nullable columns
+    are added, as SQLite can't add a NOT NULL column without a default.
+    """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
+def ensure_indexes():
+    """
+    Create any model index missing from an existing database.
+    db.create_all() only creates indexes together with new tables.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
 
 
 ###############################################################################
 # Utility Functions
 ###############################################################################
+def eager_options(*options):
+    """
+    Loader options for a query, plus raiseload('*') when testing so any
+    relationship the view forgot to eager-load fails loudly (N+1 guard).
+    """
+    if app.testing:
+        return options + (raiseload('*'),)
+    return options
+
+
+def course_detail_options():
+    """
+    Loader options for the course detail pages: the course's own columns
+    and only the id/title of its modules, leaving module content unread.
+    """
+    # Under testing, reading a deferred column raises instead of silently
+    # issuing one lazy SELECT per row (eager_options only guards relationships)
+    return eager_options(
+        load_only(Course.id, Course.title, Course.description, raiseload=app.testing),
+        selectinload(Course.modules).load_only(Module.id, Module.title, raiseload=app.testing),
+    )
+
+
+def catalog_version(course_id=None):
+    """
+    Cheap fingerprint of course, module and quiz data (row counts and
+    latest change), optionally limited to one course. Used for ETags.
+    """
+    courses = db.select(func.count(Course.id), func.max(Course.updated_at))
+    modules = db.select(func.count(Module.id), func.max(Module.updated_at))
+    questions = db.select(func.count(QuizQuestion.id), func.max(QuizQuestion.id))
+    if course_id is not None:
+        courses = courses.where(Course.id == course_id)
+        modules = modules.where(Module.course_id == course_id)
+        questions = questions.join(Module, QuizQuestion.module_id == Module.id).where(Module.course_id == course_id)
+    return tuple(tuple(db.session.execute(query).one()) for query in (courses, modules, questions))
+
+
+@cache.memoize(300)
+def module_bundle(module_id):
+    """
+    Plain-data snapshot of a module and its quiz questions for the student
+    pages, cached per module. Call invalidate_module_bundles() after
+    changing a module's quiz.
+    """
+    module = db.get_or_404(Module, module_id, options=[selectinload(Module.quiz_questions)])
+    questions = module.quiz_questions
+    return {
+        "module": {
+            "id": module.id,
+            "title": module.title,
+            "content": module.content,
+            "course_id": module.course_id,
+        },
+        "quiz_questions": [
+            {"id": q.id, "question": q.question, "options": q.options, "answer": q.answer}
+            for q in questions
+        ],
+        # Fingerprint for ETags, as catalog_version() does for courses
+        "version": (module.updated_at, len(questions), max((q.id for q in questions), default=None)),
+    }
+
+
+def invalidate_module_bundles(module_ids):
+    """Drop cached module bundles so the next read sees new quiz questions."""
+    for module_id in module_ids:
+        cache.delete_memoized(module_bundle, module_id)
+
+
+def conditional_render(version, render):
+    """
+    Answer 304 Not Modified when the browser's copy matches `version`,
+    otherwise call `render()` (which does the queries and templating).
+    Pages carrying flash messages are never cached.
+    """
+    if '_flashes' in session:
+        return make_response(render())
+
+    etag = hashlib.md5(repr((session.get('user_id'), version)).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    # Revalidate on every navigation: after a redirect the page may carry
+    # new data or a flash message, and the 304 keeps that round-trip cheap
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def modules_needing_quiz(module_ids=None):
+    """
+    Modules that have no quiz yet, limited to `module_ids` (form values)
+    when any are given.
+    """
+    module_ids = [int(mid) for mid in module_ids or [] if str(mid).isdigit()]
+    quizzed_ids = db.session.query(QuizQuestion.module_id).distinct()
+    query = Module.query.filter(Module.id.notin_(quizzed_ids))
+    if module_ids:
+        query = query.filter(Module.id.in_(module_ids))
+    return query.all()
+
+
+def quiz_lock(module_id, timeout=120):
+    """
+    Redis lock guarding quiz generation for one module across all workers,
+    so concurrent requests can't both insert a quiz for it.
+    """
+    return redis_client.lock(f"quizlock:{module_id}", timeout=timeout)
+
+
+def sse_event(data, event=None):
+    """Format text as one server-sent event (one data line per text line)."""
+    prefix = f"event: {event}\n" if event else ""
+    return prefix + "".join(f"data: {line}\n" for line in data.split('\n')) + "\n"
+
+
+# Sent after the last chunk: EventSource reconnects when a stream simply
+# closes, which would ask the same question again.
+SSE_DONE = sse_event("", event="done")
+
+
+def sse_response(events):
+    """
+    Event-stream response that is not cached or buffered on the way to the
+    browser (X-Accel-Buffering stops nginx from holding the chunks back).
+    """
+    return Response(events, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def current_role():
+    """
+    Role of the logged-in user. It is cached in the server-side session
+    at login; the database is only queried for sessions without it.
+    """
+    role = session.get('role')
+    if role is None:
+        user = db.session.get(User, session['user_id'])
+        if user:
+            role = session['role'] = user.role
+    return role
+
+
 def admin_required(func):
     """Decorator to ensure the user is an admin."""
     def wrapper(*args, **kwargs):
@@ -175,8 +541,7 @@ def admin_required(func):
             flash("Please login first.", "warning")
             return redirect(url_for('login'))
 
-        user = User.query.get(session['user_id'])
-        if not user or user.role != 'admin':
+        if current_role() != 'admin':
             flash("Admin rights required.", "danger")
             return redirect(url_for('index'))
         return func(*args, **kwargs)
@@ -190,8 +555,7 @@ def student_required(func):
         if 'user_id' not in session:
             flash("Please login first.", "warning")
             return redirect(url_for('login'))
-        user = User.query.get(session['user_id'])
-        if not user or user.role != 'student':
+        if current_role() != 'student':
             flash("Student account required.", "danger")
             return redirect(url_for('index'))
         return func(*args, **kwargs)
@@ -199,13 +563,12 @@ def student_required(func):
     return wrapper
 
 
-def generate_quiz_questions(module_content, num_questions=5):
+def build_quiz_messages(module_content, num_questions=5):
     """
-    Uses OpenAI to generate multiple-choice quiz questions
-    based on the module's content.
+    Build the chat messages asking for multiple-choice quiz questions
+    on the module's content. Shared by the direct and batch paths.
     """
-
-    messages = [
+    return [
         {"role": "system", "content": "You are an educational AI system."},
         {"role": "user", "content": f"""
         Based on the following content:
@@ -213,62 +576,287 @@ def generate_quiz_questions(module_content, num_questions=5):
         {module_content}
 
         Generate {num_questions} multiple-choice quiz questions. 
-        Each question should have 4 distinct options (A, B, C, D), 
-        and indicate which option is correct in this format:
-
-        1) Question text
-        A) ...
-        B) ...
-        C) ...
-        D) ...
-        Correct answer: X
+        Each question should have exactly 4 distinct options, listed in
+        order A, B, C, D without letter prefixes, and the letter of the
+        correct option as the answer.
+        """}
+    ]
 
-        Provide them in a plain text format.
+def build_multi_quiz_request(modules, num_questions=5):
+    """
+    Request parameters asking for quizzes on several modules in a single
+    completion, so the system prompt and HTTP round-trip are shared.
+    """
+    sections = "\n\n".join(f"===MODULE {m.id}===\n{m.content}" for m in modules)
+    messages = [
+        {"role": "system", "content": "You are an educational AI system."},
+        {"role": "user", "content": f"""
+        For each of the following modules, generate {num_questions} multiple-choice
+        quiz questions based only on that module's content. Each module starts
+        with a line ===MODULE <id>===; return one quiz per module with its id.
+        Each question should have exactly 4 distinct options, listed in
+        order A, B, C, D without letter prefixes, and the letter of the
+        correct option as the answer.
+
+        {sections}
         """}
     ]
+    return dict(
+        QUIZ_REQUEST_PARAMS,
+        messages=messages,
+        max_tokens=QUIZ_REQUEST_PARAMS["max_tokens"] * len(modules),
+        response_format=MULTI_QUIZ_RESPONSE_FORMAT,
+    )
+
+def split_multi_quiz_output(generated_text):
+    """
+    Split a multi-module quiz response into {module_id: quiz JSON}, each
+    value in the single-module format read by parse_quiz_output().
+    """
+    try:
+        data = json.loads(generated_text)
+    except ValueError:
+        return {}
+    return {
+        quiz["module_id"]: json.dumps({"questions": quiz["questions"]})
+        for quiz in data.get("quizzes", [])
+    }
 
+def generate_quiz_questions(module_content, num_questions=5):
+    """
+    Uses OpenAI to generate multiple-choice quiz questions
+    based on the module's content. Returns the quiz as a JSON string
+    matching QUIZ_RESPONSE_FORMAT.
+    """
     response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        max_tokens=700
+        messages=build_quiz_messages(module_content, num_questions),
+        **QUIZ_REQUEST_PARAMS
     )
 
     return response.choices[0].message.content.strip()
 
-def generate_adaptive_response(course_content, student_question):
+def quiz_cache_key(module_content, num_questions=5):
+    """Content-addressed key for a generated quiz."""
+    return hashlib.sha256(f"{num_questions}:{module_content}".encode('utf-8')).hexdigest()
+
+def parse_quiz_output(generated_text, module_id):
     """
-    Uses OpenAI to provide an adaptive learning response 
-    based on the course content and student's question.
+    Turn a structured (JSON) quiz response into quiz_questions rows.
+    Falls back to the plain-text parser for outputs produced before
+    structured output was used (e.g. batch jobs submitted earlier).
     """
-    # client = OpenAI()
+    try:
+        data = json.loads(generated_text)
+    except ValueError:
+        return parse_quiz_text(generated_text, module_id)
+
+    questions = []
+    for q in data.get("questions", []):
+        if len(q["options"]) != 4:
+            continue
+        questions.append(dict(
+            question=q["question"].strip(),
+            options=[f"{letter}) {option.strip()}" for letter, option in zip("ABCD", q["options"])],
+            answer=q["answer"],
+            module_id=module_id
+        ))
+    return questions
+
+# One whole question block of a plain-text quiz:
+# "<n>) question", four "A) ..".."D) .." lines, then "Correct answer: X"
+QUIZ_BLOCK_RE = re.compile(
+    r'^[ \t]*\d+\)[ \t]*(.+)\s*'
+    r'^[ \t]*(A\).+)\s*'
+    r'^[ \t]*(B\).+)\s*'
+    r'^[ \t]*(C\).+)\s*'
+    r'^[ \t]*(D\).+)\s*'
+    r'^[ \t]*Correct answer:[ \t]*([A-D])',
+    re.MULTILINE
+)
 
-    messages = [
-        {"role": "system", "content": "You are a tutoring AI. Your goal is to provide clear, informative, and concise explanations based on the provided course content."},
-        {"role": "user", "content": f"""
-        The course content is:
+def parse_quiz_text(generated_text, module_id):
+    """
+    Parse the generated quiz text into quiz_questions rows for a module.
+    Blocks that don't match the expected layout are skipped.
+    """
+    return [
+        dict(
+            question=m.group(1).strip(),
+            options=[m.group(i).strip() for i in range(2, 6)],
+            answer=m.group(6),
+            module_id=module_id
+        )
+        for m in QUIZ_BLOCK_RE.finditer(generated_text)
+    ]
 
-        {course_content}
+# Kept byte-identical across calls so OpenAI's prompt caching can reuse
+# the system + course content prefix; only the final question varies.
+STATIC_TUTOR_SYSTEM = (
+    "You are a tutoring AI. Your goal is to provide clear, informative, and concise "
+    "explanations based on the provided course content. Answer each student question "
+    "with an explanation that directly addresses it using the course content."
+)
 
-        The student asks: {student_question}
 
-        Provide an explanation that directly addresses the student's question using the course content.
-        """}
+def build_tutor_messages(course_content, student_question):
+    """
+    Build the chat messages for a tutor answer. Shared by the buffered
+    and streaming tutor paths. The course content comes before the
+    question so the prefix is the same for every question on a module.
+    """
+    return [
+        {"role": "system", "content": STATIC_TUTOR_SYSTEM},
+        {"role": "user", "content": f"Course content:\n{course_content}"},
+        {"role": "assistant", "content": "Understood. Ask your question."},
+        {"role": "user", "content": student_question},
     ]
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
+def submit_batch_quiz_job(items):
+    """
+    Submit quiz generation for (module_id, content) pairs as one OpenAI
+    Batch API job (half the token price, results within 24h) and record
+    it as a QuizBatchJob; poll_batch imports the quizzes once it completes.
+    """
+    batch = submit_quiz_batch(
+        client,
+        items,
+        build_quiz_messages,
+        **QUIZ_REQUEST_PARAMS
+    )
+    job = QuizBatchJob(
+        batch_id=batch.id,
+        status=batch.status,
+        module_ids=",".join(str(module_id) for module_id, _ in items)
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def tutor_cache_keys(course_content, student_question):
+    """
+    Return (content_hash, key) for a tutor question: content_hash scopes
+    semantic matches to the same course content, key is the exact match.
+    """
+    content_hash = hashlib.sha256(course_content.encode('utf-8')).hexdigest()
+    key = hashlib.sha256(f"{content_hash}:{student_question}".encode('utf-8')).hexdigest()
+    return content_hash, key
+
+def find_similar_tutor_answer(content_hash, embedding):
+    """
+    Return a cached answer to a question on the same content whose
+    embedding has cosine similarity >= SEMANTIC_CACHE_THRESHOLD, else None.
+    """
+    rows = db.session.query(LLMCache.embedding, LLMCache.response).filter_by(prompt_hash=content_hash).all()
+    if not rows:
+        return None
+
+    matrix = np.stack([np.frombuffer(row_embedding, dtype=np.float32) for row_embedding, _ in rows])
+    query = np.asarray(embedding, dtype=np.float32)
+    similarities = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query))
+    best = int(np.argmax(similarities))
+    if similarities[best] >= SEMANTIC_CACHE_THRESHOLD:
+        return rows[best][1]
+    return None
+
+def store_tutor_answer(content_hash, key, embedding, answer):
+    """
+    Cache a generated tutor answer for exact and semantic lookups. Empty
+    answers are skipped, or every later match would return nothing.
+    """
+    if not answer:
+        return
+    db.session.add(LLMCache(
+        key=key,
+        prompt_hash=content_hash,
+        embedding=np.asarray(embedding, dtype=np.float32).tobytes(),
+        response=answer
+    ))
+    db.session.commit()
+
+@openai_retry
+def embed_tutor_question(student_question):
+    """Embedding of a student question, for the semantic tutor cache."""
+    return client.embeddings.create(model=EMBEDDING_MODEL, input=student_question).data[0].embedding
+
+@openai_retry
+def request_tutor_answer(course_content, student_question, stream=False):
+    """
+    Ask OpenAI for a tutor answer, or start streaming one (retries then
+    cover opening the stream only).
+    """
+    return client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=build_tutor_messages(course_content, student_question),
         max_tokens=400,
+        stream=stream,
     )
 
-    return response.choices[0].message.content.strip()
+def generate_adaptive_response(course_content, student_question):
+    """
+    Uses OpenAI to provide an adaptive learning response 
+    based on the course content and student's question.
+    """
+    content_hash, key = tutor_cache_keys(course_content, student_question)
+    cached = LLMCache.query.filter_by(key=key).first()
+    if cached:
+        return cached.response
+
+    # The sync client yields to other greenlets under gevent; the semaphore
+    # bounds in-flight tutor calls per process.
+    with tutor_semaphore:
+        embedding = embed_tutor_question(student_question)
+        answer = find_similar_tutor_answer(content_hash, embedding)
+        if answer is not None:
+            return answer
+        response = request_tutor_answer(course_content, student_question)
+
+    answer = (response.choices[0].message.content or "").strip()
+    store_tutor_answer(content_hash, key, embedding, answer)
+    return answer
+
+def templates_version():
+    """
+    Fingerprint of the template files at startup. It is part of the
+    static render cache key, so a deploy with edited templates doesn't
+    serve pages rendered from the old ones.
+    """
+    digest = hashlib.md5()
+    folder = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, folder).encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+TEMPLATES_VERSION = templates_version()
+
+
+@cache.memoize(3600)
+def _render_static_cached(template, version):
+    return render_template(template)
+
+
+def render_static(template):
+    """
+    Render a template that only depends on the session (flashed messages,
+    logged-in user). Anonymous visitors with nothing flashed all get the
+    same page, so that case is rendered once and cached. In debug mode
+    templates are always rendered, so edits show up on reload.
+    """
+    if app.debug or 'user_id' in session or session.get('_flashes'):
+        return render_template(template)
+    return _render_static_cached(template, TEMPLATES_VERSION)
 
 ###############################################################################
 # Routes - Authentication
 ###############################################################################
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_static('index.html')
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -283,7 +871,7 @@ def register():
 
         new_user = User(
             username=username,
-            password_hash=generate_password_hash(password),
+            password_hash=password_hasher.hash(password),
             role=role
         )
         db.session.add(new_user)
@@ -291,7 +879,7 @@ def register():
         flash("Registration successful. You can now login.", "success")
         return redirect(url_for('login'))
 
-    return render_template('register.html')
+    return render_static('register.html')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -300,6 +888,8 @@ def login():
         password = request.form.get('password')
         user = User.query.filter_by(username=username).first()
         if user and user.check_password(password):
+            if user in db.session.dirty:
+                db.session.commit()  # Persist an upgraded password hash
             session['user_id'] = user.id
             session['role'] = user.role
             flash("Logged in successfully.", "success")
@@ -310,7 +900,7 @@ def login():
         else:
             flash("Invalid credentials.", "danger")
 
-    return render_template('login.html')
+    return render_static('login.html')
 
 @app.route('/logout')
 def logout():
@@ -325,8 +915,10 @@ def logout():
 @app.route('/admin/dashboard')
 @admin_required
 def admin_dashboard():
-    courses = Course.query.all()
-    return render_template('admin_dashboard.html', courses=courses)
+    def render():
+        courses = Course.query.options(*eager_options(selectinload(Course.modules))).all()
+        return render_template('admin_dashboard.html', courses=courses)
+    return conditional_render(catalog_version(), render)
 
 @app.route('/admin/create_course', methods=['GET', 'POST'])
 @admin_required
@@ -344,13 +936,15 @@ def create_course():
 @app.route('/admin/course/<int:course_id>')
 @admin_required
 def admin_course_detail(course_id):
-    course = Course.query.get_or_404(course_id)
-    return render_template('admin_course_detail.html', course=course)
+    def render():
+        course = db.get_or_404(Course, course_id, options=course_detail_options())
+        return render_template('admin_course_detail.html', course=course)
+    return conditional_render(catalog_version(course_id), render)
 
 @app.route('/admin/create_module/<int:course_id>', methods=['GET', 'POST'])
 @admin_required
 def create_module(course_id):
-    course = Course.query.get_or_404(course_id)
+    course = db.get_or_404(Course, course_id)
     if request.method == 'POST':
         title = request.form.get('title')
         content = request.form.get('content')
@@ -364,59 +958,204 @@ def create_module(course_id):
 @app.route('/admin/generate_quiz/<int:module_id>')
 @admin_required
 def generate_quiz(module_id):
-    module = Module.query.get_or_404(module_id)
-    existing_questions = QuizQuestion.query.filter_by(module_id=module.id).all()
+    module = db.get_or_404(Module, module_id)
 
-    # If quiz already exists, skip generation or handle it as desired
-    if existing_questions:
-        flash("Quiz already generated for this module.", "info")
+    # Only one request per module may generate at a time, across all workers;
+    # concurrent clicks short-circuit instead of paying for a second quiz.
+    lock = quiz_lock(module.id)
+    if not lock.acquire(blocking=False):
+        flash("Quiz generation for this module is already in progress.", "info")
         return redirect(url_for('admin_course_detail', course_id=module.course_id))
 
-    generated_text = generate_quiz_questions(module.content, num_questions=5)
-    # Parse the response to store questions in DB
-    # This parsing is simplistic; you may need more robust parsing in production
-    lines = generated_text.split('\n')
-    question_text = ""
-    options = []
-    correct_answer = ""
-
-    for line in lines:
-        line = line.strip()
-        if line.startswith(('1)', '2)', '3)', '4)', '5)')):
-            # Save previous question if it exists
-            if question_text and options and correct_answer:
-                # Store in DB
-                q = QuizQuestion(
-                    question=question_text,
-                    options="|".join(options),
-                    answer=correct_answer,
-                    module_id=module.id
-                )
-                db.session.add(q)
-                question_text, options, correct_answer = "", [], ""
-            # Start new question
-            question_text = line[2:].strip()
-
-        elif line.startswith(('A)', 'B)', 'C)', 'D)')):
-            options.append(line)
-
-        elif line.startswith("Correct answer:"):
-            correct_answer = line.split("Correct answer:")[-1].strip()
-
-    # Store the last question if still present
-    if question_text and options and correct_answer:
-        q = QuizQuestion(
-            question=question_text,
-            options="|".join(options),
-            answer=correct_answer,
-            module_id=module.id
-        )
-        db.session.add(q)
+    try:
+        # If quiz already exists, skip generation or handle it as desired
+        if QuizQuestion.query.filter_by(module_id=module.id).first():
+            flash("Quiz already generated for this module.", "info")
+            return redirect(url_for('admin_course_detail', course_id=module.course_id))
+
+        # Reuse the quiz generated earlier for identical content, if any
+        cache_key = quiz_cache_key(module.content, 5)
+        cached = db.session.get(QuizCache, cache_key)
+        if cached:
+            generated_text = cached.payload
+        else:
+            generated_text = generate_quiz_questions(module.content, num_questions=5)
+
+        rows = parse_quiz_output(generated_text, module.id)
+        if rows:
+            db.session.execute(db.insert(QuizQuestion), rows)
+            if not cached:
+                db.session.add(QuizCache(key=cache_key, payload=generated_text))
+        db.session.commit()
+        invalidate_module_bundles([module.id])
+    finally:
+        if lock.owned():
+            lock.release()
 
-    db.session.commit()
     flash("Quiz generated successfully!", "success")
     return redirect(url_for('admin_course_detail', course_id=module.course_id))
 
+@app.route('/admin/generate_quizzes_bulk', methods=['POST'])
+@admin_required
+def generate_quizzes_bulk():
+    """
+    Submit quiz generation for many modules as one OpenAI Batch API job.
+    Uses the selected module ids, or every module without a quiz yet.
+    """
+    modules = modules_needing_quiz(request.form.getlist('module_ids'))
+    if not modules:
+        flash("No modules need quiz generation.", "info")
+        return redirect(url_for('admin_dashboard'))
+
+    try:
+        job = submit_batch_quiz_job([(m.id, m.content) for m in modules])
+    except Exception as e:
+        flash(f"Error submitting batch: {str(e)}", "danger")
+        return redirect(url_for('admin_dashboard'))
+
+    flash(f"Submitted quiz generation for {len(modules)} module(s) as batch job {job.id}.", "success")
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/generate_quizzes_parallel', methods=['POST'])
+@admin_required
+def generate_quizzes_parallel():
+    """
+    Generate quizzes for many modules now, with the OpenAI calls running
+    concurrently under the account's rate limits. Uses the selected module
+    ids, or every module without a quiz yet.
+    """
+    modules = modules_needing_quiz(request.form.getlist('module_ids'))
+    if not modules:
+        flash("No modules need quiz generation.", "info")
+        return redirect(url_for('admin_dashboard'))
+
+    # Take the same per-module locks as generate_quiz, without waiting;
+    # modules another request is already generating are skipped
+    locks = {}
+    for m in modules:
+        lock = quiz_lock(m.id, timeout=600)
+        if lock.acquire(blocking=False):
+            locks[m.id] = lock
+    busy_modules = len(modules) - len(locks)
+    modules = [m for m in modules if m.id in locks]
+
+    try:
+        if not modules:
+            flash("Quiz generation for these modules is already in progress.", "info")
+            return redirect(url_for('admin_dashboard'))
+
+        # Serve identical content from the quiz cache; only misses go to OpenAI
+        cache_keys = {m.id: quiz_cache_key(m.content, 5) for m in modules}
+        cached = {c.key: c.payload for c in QuizCache.query.filter(QuizCache.key.in_(cache_keys.values()))}
+        misses = [m for m in modules if cache_keys[m.id] not in cached]
+
+        # Several modules per request, and the requests run concurrently
+        packs = [misses[i:i + QUIZ_MODULES_PER_REQUEST] for i in range(0, len(misses), QUIZ_MODULES_PER_REQUEST)]
+        generated = batch_chat(client, [build_multi_quiz_request(pack, 5) for pack in packs])
+        fresh = {}
+        for pack, generated_text in zip(packs, generated):
+            quizzes = split_multi_quiz_output(generated_text) if generated_text else {}
+            fresh.update((m.id, quizzes[m.id]) for m in pack if m.id in quizzes)
+
+        # A module may have been given a quiz (e.g. by a batch import) while
+        # the OpenAI calls were running
+        quizzed_ids = set(db.session.scalars(
+            db.select(QuizQuestion.module_id).where(QuizQuestion.module_id.in_(list(locks))).distinct()
+        ))
+
+        rows = []
+        generated_ids = []
+        for m in modules:
+            if m.id in quizzed_ids:
+                continue
+            cache_key = cache_keys[m.id]
+            generated_text = cached.get(cache_key) or fresh.get(m.id)
+            module_rows = parse_quiz_output(generated_text, m.id) if generated_text else []
+            if not module_rows:
+                continue
+            rows.extend(module_rows)
+            generated_ids.append(m.id)
+            # Cache only payloads that parsed, as generate_quiz does; modules
+            # with identical content share one cache entry
+            if cache_key not in cached:
+                cached[cache_key] = generated_text
+                db.session.add(QuizCache(key=cache_key, payload=generated_text))
+
+        if rows:
+            db.session.execute(db.insert(QuizQuestion), rows)
+        db.session.commit()
+        invalidate_module_bundles(generated_ids)
+    finally:
+        for lock in locks.values():
+            if lock.owned():
+                lock.release()
+
+    generated_modules = len(generated_ids)
+    message = f"Generated quizzes for {generated_modules} of {len(modules)} module(s)."
+    if busy_modules:
+        message += f" Skipped {busy_modules} module(s) already being generated."
+    flash(message, "success")
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/poll_batch/<int:job_id>')
+@admin_required
+def poll_batch(job_id):
+    """Check a batch job and import its quizzes once the batch has completed."""
+    job = db.get_or_404(QuizBatchJob, job_id)
+    if job.status == 'imported':
+        flash("Quizzes from this batch were already imported.", "info")
+        return redirect(url_for('admin_dashboard'))
+    if job.status in ('failed', 'expired', 'cancelled'):
+        flash(f"Batch job {job.id} {job.status} without any quizzes to import.", "warning")
+        return redirect(url_for('admin_dashboard'))
+
+    try:
+        status, results, errors = fetch_batch_results(client, job.batch_id)
+    except Exception as e:
+        flash(f"Error polling batch: {str(e)}", "danger")
+        return redirect(url_for('admin_dashboard'))
+
+    if results is None:
+        job.status = status
+        db.session.commit()
+        flash(f"Batch job {job.id} is {status}.", "info")
+        return redirect(url_for('admin_dashboard'))
+
+    # Skip modules that got a quiz some other way while the batch was running
+    quizzed_ids = {mid for (mid,) in db.session.query(QuizQuestion.module_id).distinct()}
+    imported_ids = []
+    rows = []
+    for custom_id, generated_text in results.items():
+        module_id = int(custom_id)
+        if module_id in quizzed_ids:
+            continue
+        module_rows = parse_quiz_output(generated_text, module_id)
+        if not module_rows:
+            errors.append(f"{custom_id}: quiz output could not be parsed")
+            continue
+        rows.extend(module_rows)
+        imported_ids.append(module_id)
+
+    if rows:
+        db.session.execute(db.insert(QuizQuestion), rows)
+
+    # The batch is finished either way; a completed batch whose every
+    # request failed is recorded as failed so it isn't polled again
+    if results:
+        job.status = 'imported'
+    else:
+        job.status = 'failed' if status == 'completed' else status
+    db.session.commit()
+    invalidate_module_bundles(imported_ids)
+    if errors:
+        flash(f"Batch job {job.id}: {len(errors)} request(s) failed, e.g. {errors[0]}", "warning")
+    if not results:
+        flash(f"Batch job {job.id} {job.status} without any quizzes to import.", "danger")
+        return redirect(url_for('admin_dashboard'))
+    imported_modules = len(imported_ids)
+    flash(f"Imported quizzes for {imported_modules} module(s) from batch job {job.id}.", "success")
+    return redirect(url_for('admin_dashboard'))
+
 # @app.route('/admin/analytics')
 # @admin_required
 # def analytics():
@@ -436,33 +1175,35 @@ def generate_quiz(module_id):
 @app.route('/admin/analytics')
 @admin_required
 def analytics():
-    # Basic analytics for each module
-    all_modules = Module.query.all()
-    
-    module_data = []
-    for m in all_modules:
-        attempts = QuizAttempt.query.filter_by(module_id=m.id).all()
-        
-        if attempts:
-            scores = [a.score for a in attempts]
-            avg_score = sum(scores) / len(scores)
-            max_score = max(scores)
-            min_score = min(scores)
-            attempts_count = len(scores)
-        else:
-            avg_score = None
-            max_score = None
-            min_score = None
-            attempts_count = 0
+    # Basic analytics for each module, aggregated in a single query.
+    # Attempts are grouped by module_id first (an indexed scan of
+    # quiz_attempts), then left-joined so modules without attempts remain.
+    stats = db.session.query(
+        QuizAttempt.module_id.label('module_id'),
+        func.avg(QuizAttempt.score).label('avg_score'),
+        func.max(QuizAttempt.score).label('max_score'),
+        func.min(QuizAttempt.score).label('min_score'),
+        func.count(QuizAttempt.score).label('attempts_count'),
+    ).group_by(QuizAttempt.module_id).subquery()
+
+    rows = db.session.query(
+        Module.title,
+        stats.c.avg_score,
+        stats.c.max_score,
+        stats.c.min_score,
+        func.coalesce(stats.c.attempts_count, 0),
+    ).outerjoin(stats, stats.c.module_id == Module.id).order_by(Module.id).all()
 
+    module_data = []
+    for title, avg_score, max_score, min_score, attempts_count in rows:
         module_data.append({
-            "title": m.title,
+            "title": title,
             "avg_score": round(avg_score, 2) if avg_score is not None else None,
             "max_score": round(max_score, 2) if max_score is not None else None,
             "min_score": round(min_score, 2) if min_score is not None else None,
             "attempts_count": attempts_count,
         })
-    
+
     return render_template('analytics.html', module_data=module_data)
 
 
@@ -472,60 +1213,127 @@ def analytics():
 @app.route('/student/dashboard')
 @student_required
 def student_dashboard():
-    courses = Course.query.all()
-    return render_template('student_dashboard.html', courses=courses)
+    def render():
+        courses = Course.query.options(*eager_options(selectinload(Course.modules))).all()
+        return render_template('student_dashboard.html', courses=courses)
+    return conditional_render(catalog_version(), render)
 
 @app.route('/student/course/<int:course_id>')
 @student_required
 def student_course_detail(course_id):
-    course = Course.query.get_or_404(course_id)
-    return render_template('student_course_detail.html', course=course)
+    def render():
+        course = db.get_or_404(Course, course_id, options=course_detail_options())
+        return render_template('student_course_detail.html', course=course)
+    return conditional_render(catalog_version(course_id), render)
 
 @app.route('/student/module/<int:module_id>', methods=['GET', 'POST'])
 @student_required
 def student_module_detail(module_id):
-    module = Module.query.get_or_404(module_id)
+    bundle = module_bundle(module_id)
+
+    def render(adaptive_answer=None):
+        return render_template(
+            'student_module_detail.html',
+            module=bundle["module"],
+            quiz_questions=bundle["quiz_questions"],
+            adaptive_answer=adaptive_answer
+        )
+
+    if request.method == 'GET':
+        return conditional_render(bundle["version"], render)
 
     # Handling question submission for adaptive answers
-    adaptive_answer = None
-    if request.method == 'POST':
-        student_question = request.form.get('student_question')
-        adaptive_answer = generate_adaptive_response(module.content, student_question)
-
-    quiz_questions = QuizQuestion.query.filter_by(module_id=module.id).all()
-    return render_template(
-        'student_module_detail.html',
-        module=module,
-        quiz_questions=quiz_questions,
-        adaptive_answer=adaptive_answer
-    )
+    student_question = request.form.get('student_question')
+    adaptive_answer = generate_adaptive_response(bundle["module"]["content"], student_question)
+    return render(adaptive_answer)
+
+@app.route('/student/module/<int:module_id>/ask')
+@student_required
+def student_module_ask(module_id):
+    """
+    Stream the tutor's answer as server-sent events, so the page can show
+    tokens as they arrive (consume with EventSource and close it on the
+    "done" event). The POST form on student_module_detail remains the
+    non-JS path.
+    """
+    module_content = module_bundle(module_id)["module"]["content"]
+    student_question = request.args.get('student_question', '').strip()
+    if not student_question:
+        abort(400)
+
+    content_hash, key = tutor_cache_keys(module_content, student_question)
+    cached = LLMCache.query.filter_by(key=key).first()
+    if cached:
+        return sse_response(sse_event(cached.response) + SSE_DONE)
+
+    # Held until the response is closed, so the slot covers the whole
+    # stream, as generate_adaptive_response does for the buffered path
+    tutor_semaphore.acquire()
+    try:
+        embedding = embed_tutor_question(student_question)
+        answer = find_similar_tutor_answer(content_hash, embedding)
+        stream = request_tutor_answer(module_content, student_question, stream=True) if answer is None else None
+    except BaseException:
+        tutor_semaphore.release()
+        raise
+    if answer is not None:
+        tutor_semaphore.release()
+        return sse_response(sse_event(answer) + SSE_DONE)
+
+    def generate():
+        parts = []
+        for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            parts.append(chunk.choices[0].delta.content)
+            yield sse_event(parts[-1])
+        yield SSE_DONE
+        store_tutor_answer(content_hash, key, embedding, "".join(parts).strip())
+
+    # Don't hold the cache lookups' read transaction (and its pooled SQLite
+    # connection, which also blocks WAL checkpoints) for the whole stream;
+    # store_tutor_answer opens a fresh one at the end
+    db.session.close()
+
+    response = sse_response(stream_with_context(generate()))
+    response.call_on_close(tutor_semaphore.release)
+    return response
 
 @app.route('/student/quiz/<int:module_id>', methods=['GET', 'POST'])
 @student_required
 def student_quiz(module_id):
-    module = Module.query.get_or_404(module_id)
-    quiz_questions = QuizQuestion.query.filter_by(module_id=module.id).all()
-    
+    bundle = module_bundle(module_id)
+
     if request.method == 'POST':
-        correct_count = 0
-        for q in quiz_questions:
-            selected_option = request.form.get(f"question_{q.id}")
-            if selected_option == q.answer:
-                correct_count += 1
-        score = (correct_count / len(quiz_questions)) * 100
+        # Quizzes are never edited once generated, and every change that
+        # adds one drops the bundle, so grade against its cached answers
+        answers = {
+            int(key[len('question_'):]): value
+            for key, value in request.form.items()
+            if key.startswith('question_') and key[len('question_'):].isdigit()
+        }
+        questions = bundle["quiz_questions"]
+        correct_count = sum(1 for q in questions if answers.get(q["id"]) == q["answer"])
+        total = len(questions)
+        if not total:
+            # Nothing to grade; don't record an attempt that skews analytics
+            flash("No quiz for this module yet.", "info")
+            return redirect(url_for('student_module_detail', module_id=module_id))
+
+        score = (correct_count / total) * 100
         # Save attempt
         attempt = QuizAttempt(
             user_id=session['user_id'],
-            module_id=module.id,
+            module_id=module_id,
             score=score
         )
         db.session.add(attempt)
         db.session.commit()
 
         flash(f"You scored {score:.2f}%.", "info")
-        return redirect(url_for('student_module_detail', module_id=module.id))
+        return redirect(url_for('student_module_detail', module_id=module_id))
 
-    return render_template('student_quiz.html', module=module, quiz_questions=quiz_questions)
+    return render_template('student_quiz.html', module=bundle["module"], quiz_questions=bundle["quiz_questions"])
 
 
 ###############################################################################
@@ -538,52 +1346,46 @@ from flask import render_template, redirect, url_for, flash
 # from yourapp.models import Course  # Import your Course model
 # from yourapp.utils import import_modules_for_course  # Assuming you put the helper function in utils.py
 
-def import_modules_for_course(moodle_course_id, local_course):
+def import_modules_for_course(sections, local_course):
     """
-    Given a Moodle course id and a local Course instance,
-    fetch the course contents from Moodle and import modules.
+    Given the Moodle course contents (see fetch_course_contents) and a
+    local Course instance, import the course's modules.
+    Returns (module_id, content) for the newly created modules.
     """
-    moodle_url = os.environ.get("MOODLE_URL", "https://your-moodle.com")
-    moodle_token = os.environ.get("MOODLE_TOKEN", "your_moodle_token")
-    endpoint = f"{moodle_url}/webservice/rest/server.php"
-    function_name = "core_course_get_contents"
-    
-    params = {
-        "wstoken": moodle_token,
-        "wsfunction": function_name,
-        "moodlewsrestformat": "json",
-        "courseid": moodle_course_id,
-    }
-    
-    response = requests.get(endpoint, params=params)
-    response.raise_for_status()
-    sections = response.json()
-
-    print(sections)
-    
-    imported_modules_count = 0
-    # Iterate over each section in the course.
-    for section in sections:
-        # Each section typically contains a list of modules.
-        for module in section.get("modules", []):
-            # Optionally, filter out modules by type:
-            # if module.get("modname") not in ["resource", "assign", "quiz"]:
-            #     continue
-            # Check if a module with the same title already exists for this course.
-            existing_module = Module.query.filter_by(title=module.get("name"), course_id=local_course.id).first()
-            if existing_module:
-                continue  # Skip duplicate modules
-            
-            new_module = Module(
-                title=module.get("name", "Untitled Module"),
-                # Use the module’s description if available; otherwise, fall back to the section summary.
-                content=module.get("description") or section.get("summary", ""),
-                course_id=local_course.id
-            )
-            db.session.add(new_module)
-            imported_modules_count += 1
+    # Each section typically contains a list of modules.
+    incoming = [(module, section) for section in sections for module in section.get("modules", [])]
+    # Optionally, filter out modules by type:
+    # incoming = [(m, s) for m, s in incoming if m.get("modname") in ["resource", "assign", "quiz"]]
+
+    # The course was expired by the previous commit; its identity key
+    # gives the id without reloading it
+    course_id = inspect(local_course).identity[0]
+
+    # Look up which titles this course already has in one query
+    names = {module.get("name") for module, _ in incoming} - {None}
+    existing_titles = set(db.session.scalars(
+        db.select(Module.title).where(Module.course_id == course_id, Module.title.in_(names))
+    )) if names else set()
+
+    new_modules = []
+    for module, section in incoming:
+        name = module.get("name")
+        if name in existing_titles:
+            continue  # Skip duplicate modules
+        if name is not None:
+            existing_titles.add(name)
+        new_modules.append(Module(
+            title=module.get("name", "Untitled Module"),
+            # Use the module’s description if available; otherwise, fall back to the section summary.
+            content=module.get("description") or section.get("summary", ""),
+            course_id=course_id
+        ))
+    db.session.add_all(new_modules)
+    contents = [m.content for m in new_modules]
     db.session.commit()
-    return imported_modules_count
+    # The commit expires the instances; read the ids from their identity
+    # keys and reuse the content strings rather than refreshing each row
+    return [(inspect(m).identity[0], content) for m, content in zip(new_modules, contents)]
 
 @app.route('/admin/moodle_import', methods=['GET', 'POST'])
 @admin_required  # Make sure only admins can use this route
@@ -593,70 +1395,54 @@ def moodle_import():
         return redirect(url_for('admin_dashboard'))
     
     if request.method == 'POST':
-        moodle_url = os.environ.get("MOODLE_URL", "https://your-moodle.com")
-        moodle_token = os.environ.get("MOODLE_TOKEN", "your_moodle_token")
-        endpoint = f"{moodle_url}/webservice/rest/server.php"
-        function_name = "core_course_get_courses"
-        
-        params = {
-            "wstoken": moodle_token,
-            "wsfunction": function_name,
-            "moodlewsrestformat": "json",
-        }
-        
         try:
-            response = requests.get(endpoint, params=params)
-            response.raise_for_status()
-            moodle_courses = response.json()
+            moodle_courses = fetch_moodle_courses()
         except Exception as e:
             flash(f"Error fetching courses: {str(e)}", "danger")
             return redirect(url_for('admin_dashboard'))
         
         imported_courses = 0
-        imported_modules = 0
+        imported_modules = []
         
-        for mc in moodle_courses:
-            # Use the Moodle course's 'fullname' for the title and 'summary' for the description.
-            title = mc.get('fullname', 'Untitled')
-            description = mc.get('summary', 'No description provided')
-            
-            # Check if this course already exists locally.
-            existing_course = Course.query.filter_by(title=title).first()
-            if existing_course:
-                local_course = existing_course
-            else:
-                local_course = Course(
+        # Use the Moodle course's 'fullname' for the title and 'summary' for the description.
+        titles = [mc.get('fullname', 'Untitled') for mc in moodle_courses]
+
+        # Look up all existing courses in one query instead of one per course.
+        local_courses = {c.title: c for c in Course.query.filter(Course.title.in_(titles))}
+        for mc, title in zip(moodle_courses, titles):
+            if title not in local_courses:
+                local_courses[title] = Course(
                     title=title,
-                    description=description
+                    description=mc.get('summary', 'No description provided')
                 )
-                db.session.add(local_course)
-                db.session.commit()  # Commit to generate a local course ID.
+                db.session.add(local_courses[title])
                 imported_courses += 1
-            
-            # Import modules for this course using its Moodle course id.
+        db.session.commit()  # One commit generates the IDs for all new courses.
+
+        # Fetch all course contents concurrently (pure network wait); the
+        # database writes below stay on this thread.
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            contents = [pool.submit(fetch_course_contents, mc.get('id')) for mc in moodle_courses]
+
+        for title, future in zip(titles, contents):
+            local_course = local_courses[title]
+            # Import modules for this course from its fetched contents.
             try:
-                modules_imported = import_modules_for_course(mc.get('id'), local_course)
-                imported_modules += modules_imported
+                imported_modules.extend(import_modules_for_course(future.result(), local_course))
             except Exception as e:
-                flash(f"Error importing modules for course {local_course.title}: {str(e)}", "warning")
+                flash(f"Error importing modules for course {title}: {str(e)}", "warning")
         
-        flash(f"Imported {imported_courses} new course(s) and {imported_modules} module(s) from Moodle.", "success")
+        flash(f"Imported {imported_courses} new course(s) and {len(imported_modules)} module(s) from Moodle.", "success")
+
+        # Optionally queue quizzes for everything just imported through the Batch API
+        quiz_modules = [(module_id, content) for module_id, content in imported_modules if content.strip()]
+        if request.form.get('generate_quizzes') and quiz_modules:
+            try:
+                job = submit_batch_quiz_job(quiz_modules)
+                flash(f"Submitted quiz generation for {len(quiz_modules)} module(s) as batch job {job.id}.", "info")
+            except Exception as e:
+                flash(f"Error submitting quiz batch: {str(e)}", "warning")
         return redirect(url_for('admin_dashboard'))
     
     # For GET requests, render a simple template with an "Import from Moodle" button.
     return render_template('moodle_import.html')
-
-
-###############################################################################
-# Run the Application
-###############################################################################
-if __name__ == '__main__':
-    # Create DB tables if not exist
-    with app.app_context():
-        db.create_all()
-    app.run()
-      # Uncomment below if you want to run in debug mode
-    app.run(debug=True)
-
-    # For a production environment, consider using a production server like Gunicorn.
-    # app.run()
@@ -0,0 +1,161 @@
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def build_batch_jsonl(items, build_messages, **request_params):
+    """
+    Build the JSONL payload for the OpenAI Batch API, one request
+    per (module_id, content) pair. The module id is used as custom_id
+    so results can be routed back to their module. Extra keyword
+    arguments (model, max_tokens, ...) go into every request body.
+    """
+    lines = []
+    for module_id, content in items:
+        lines.append(json.dumps({
+            "custom_id": str(module_id),
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {"messages": build_messages(content), **request_params},
+        }))
+    return "\n".join(lines).encode("utf-8")
+
+
+def submit_quiz_batch(client, items, build_messages, **request_params):
+    """
+    Upload the quiz requests as a batch input file and start a batch job.
+    Returns the OpenAI batch object (its id must be stored to poll later).
+    """
+    payload = build_batch_jsonl(items, build_messages, **request_params)
+    batch_file = client.files.create(
+        file=("quiz_batch.jsonl", io.BytesIO(payload)),
+        purpose="batch",
+    )
+    return client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+
+
+# Batch statuses after which the job will not change any more. Expired
+# and cancelled batches may still have an output file with the requests
+# that finished in time.
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def _record_error(record):
+    """Error message for a failed line of a batch output or error file."""
+    error = record.get("error") or (record.get("response") or {}).get("body", {}).get("error") or {}
+    message = error.get("message") or f"status {(record.get('response') or {}).get('status_code')}"
+    return f"{record.get('custom_id')}: {message}"
+
+
+def fetch_batch_results(client, batch_id):
+    """
+    Poll a batch job. Returns (status, results, errors). While the batch
+    is still running results and errors are None. Once it has finished
+    (see TERMINAL_STATUSES) results maps custom_id -> generated text for
+    the requests that succeeded, and errors lists messages for the rest
+    and for batch-level failures (e.g. an invalid input file).
+    """
+    batch = client.batches.retrieve(batch_id)
+    if batch.status not in TERMINAL_STATUSES:
+        return batch.status, None, None
+
+    results = {}
+    errors = [error.message for error in (batch.errors.data or [])] if batch.errors else []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            choices = response.get("body", {}).get("choices", []) if response.get("status_code") == 200 else []
+            if not choices:
+                errors.append(_record_error(record))
+                continue
+            # Content is null when the model refuses a structured-output request
+            message = choices[0]["message"]
+            content = (message.get("content") or "").strip()
+            if content:
+                results[record["custom_id"]] = content
+            else:
+                errors.append(f"{record['custom_id']}: {message.get('refusal') or 'empty response'}")
+    return batch.status, results, errors
+
+
+class RateLimiter:
+    """
+    Token bucket for requests-per-minute and tokens-per-minute limits,
+    refilled continuously (same scheme as OpenAI's parallel processor).
+    Safe to share between threads (and gevent greenlets).
+    """
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.available_requests = rpm
+        self.available_tokens = tpm
+        self.last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.available_requests = min(self.rpm, self.available_requests + self.rpm * elapsed / 60)
+        self.available_tokens = min(self.tpm, self.available_tokens + self.tpm * elapsed / 60)
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+            time.sleep(0.05)
+
+
+def estimate_tokens(request_params):
+    """Rough token cost of a chat request: ~4 chars per prompt token plus max_tokens."""
+    prompt_chars = sum(len(message["content"]) for message in request_params["messages"])
+    return prompt_chars // 4 + request_params.get("max_tokens", 0)
+
+
+def batch_chat(client, requests_params, max_concurrency=20, rpm=500, tpm=200_000, max_attempts=5):
+    """
+    Run many chat completion requests concurrently within RPM/TPM limits,
+    on a thread pool over the sync client (greenlets under gevent).
+    `requests_params` is a list of keyword arguments for
+    chat.completions.create. Returns the reply texts in the same order,
+    with None for requests that failed.
+    """
+    limiter = RateLimiter(rpm, tpm)
+
+    def run(request_params):
+        tokens = estimate_tokens(request_params)
+        for attempt in range(max_attempts):
+            limiter.acquire(tokens)
+            try:
+                response = client.chat.completions.create(**request_params)
+                content = response.choices[0].message.content
+                return content.strip() if content else None
+            except openai.RateLimitError:
+                time.sleep(min(2 ** attempt, 30))
+            except openai.APIError:
+                return None
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        return list(pool.map(run, requests_params))
@@ -0,0 +1,14 @@
+import multiprocessing
+
+# gevent workers: requests mostly wait on OpenAI, Moodle and SQLite, so
+# each process can keep many of them in flight. Views must stay
+# synchronous; asyncio views can't run concurrently on one gevent thread.
+worker_class = "gevent"
+workers = multiprocessing.cpu_count()
+worker_connections = 200
+
+# Quiz generation can wait on several OpenAI calls in one request.
+timeout = 120
+
+# Run create_app() once in the master before the workers are forked.
+preload_app = True
@@ -0,0 +1,13 @@
+# Patch the stdlib before anything opens sockets, so the sync OpenAI,
+# Moodle and Redis clients yield to other greenlets while waiting on I/O.
+from gevent import monkey
+monkey.patch_all()
+
+from app import create_app, db  # noqa: E402
+
+app = create_app()
+
+# With --preload setup runs in the gunicorn master; don't share its
+# SQLite connections with the forked workers.
+with app.app_context():
+    db.engine.dispose()